@@ -3,11 +3,19 @@ Utility functions for parsing csv files.
 """
 
 import csv
+import io
+import mmap
+import os
+import numpy as np
 import pandas as pd 
 from tqdm import tqdm
 import math
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
 
-def extract_columns(input_file, output_file, columns_to_extract, chunksize=10000):
+def extract_columns(input_file, output_file, columns_to_extract, chunksize=100000, workers=1):
     """
     Extract specific columns from a CSV file and write them to a new CSV file.
 
@@ -15,27 +23,153 @@ def extract_columns(input_file, output_file, columns_to_extract, chunksize=10000
         input_file (csv): Input CSV file
         output_file (csv): Output CSV file
         columns_to_extract (list[strings]): List of column names to extract
-        chunksize (int, optional): Size of data that loads at once. Defaults to 10000.
+        chunksize (int, optional): Number of rows that load at once. Defaults to 100000.
+        workers (int, optional): Number of processes to parse the file with. Defaults to 1.
     """
-    # Open the output CSV file
-    with open(output_file, 'w', newline='') as outfile:
-        writer = csv.writer(outfile)
+    if workers > 1:
+        _extract_columns_parallel(input_file, output_file, columns_to_extract, chunksize, workers)
+        return
+
+    # Open the input and output CSV files
+    with open(input_file, newline='') as infile, open(output_file, 'w', newline='', buffering=1 << 20) as outfile:
+        reader = csv.reader(infile)
+        writer = csv.writer(outfile, lineterminator='\n')
+
+        # Find the positions of the columns to extract
+        header = next(reader)
+        indices = [header.index(col) for col in columns_to_extract]
         
         # Write the header
         writer.writerow(columns_to_extract)
         
-        # Get the total number of rows
-        total_rows = get_file_length(input_file)
+        # Track progress in bytes read, so the file is not scanned once just to count its rows
+        total_bytes = os.fstat(infile.fileno()).st_size
         
         # Use tqdm to create a progress bar
-        with tqdm(total=total_rows, desc="Extracting columns") as pbar:
-            # Read and process the CSV file in chunks
-            for chunk in pd.read_csv(input_file, chunksize=chunksize, usecols=columns_to_extract):
-                for _, row in chunk.iterrows():
-                    # Extract the specified columns
-                    extracted_row = [row[col] for col in columns_to_extract]
-                    writer.writerow(extracted_row)
-                    pbar.update(1)
+        with tqdm(total=total_bytes, desc="Extracting columns", unit='B', unit_scale=True) as pbar:
+            _write_columns(reader, writer, indices, chunksize,
+                           progress=lambda: pbar.update(infile.buffer.tell() - pbar.n))
+
+def _write_columns(reader, writer, indices, chunksize, progress=None):
+    """
+    Copy the fields at the given positions from every row of a CSV reader to a CSV writer.
+    Fields are copied as text, so values keep their original formatting. Blank lines are skipped
+    and missing fields are written as empty, as pandas does.
+
+    Args:
+        reader (csv.reader): Reader positioned at the first data row
+        writer (csv.writer): Writer for the output file
+        indices (list[int]): Positions of the fields to copy, in output order
+        chunksize (int): Number of rows that load at once
+        progress (callable, optional): Function called after each chunk is written. Defaults to None.
+    """
+    width = max(indices) + 1
+    while True:
+        rows = list(islice(reader, chunksize))
+        if not rows:
+            break
+        # Skip blank lines and pad short rows, such as a truncated last row, with empty fields
+        writer.writerows([row[i] for i in indices] if len(row) >= width else
+                         [(row + [''] * width)[i] for i in indices]
+                         for row in rows if row)
+        if progress is not None:
+            progress()
+
+def _extract_columns_parallel(input_file, output_file, columns_to_extract, chunksize, workers, range_size=64 << 20):
+    """
+    Extract specific columns from a CSV file using several processes, each handling a range of bytes.
+
+    Args:
+        input_file (csv): Input CSV file
+        output_file (csv): Output CSV file
+        columns_to_extract (list[strings]): List of column names to extract
+        chunksize (int): Number of rows that load at once in each process
+        workers (int): Number of processes to parse the file with
+        range_size (int, optional): Approximate size in bytes of the range handled by each task. Defaults to 64 MB.
+    """
+    header = list_columns(input_file)
+    indices = [header.index(col) for col in columns_to_extract]
+    byte_ranges = _split_byte_ranges(input_file, range_size)
+    part_files = [f"{output_file}.part{i}" for i in range(len(byte_ranges))]
+
+    with open(output_file, 'w', newline='') as outfile:
+        writer = csv.writer(outfile, lineterminator='\n')
+        writer.writerow(columns_to_extract)
+
+    total_bytes = sum(end - start for start, end in byte_ranges)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor, \
+             tqdm(total=total_bytes, desc="Extracting columns", unit='B', unit_scale=True) as pbar, \
+             open(output_file, 'ab') as outfile:
+            futures = [executor.submit(_extract_range, input_file, start, end, indices, part_file, chunksize)
+                       for (start, end), part_file in zip(byte_ranges, part_files)]
+            try:
+                # Append the parts in order so the rows keep the order of the input file
+                for future, (start, end), part_file in zip(futures, byte_ranges, part_files):
+                    future.result()
+                    with open(part_file, 'rb') as part:
+                        shutil.copyfileobj(part, outfile, 1 << 20)
+                    os.remove(part_file)
+                    pbar.update(end - start)
+            except BaseException:
+                # Don't start the ranges that are still queued
+                for future in futures:
+                    future.cancel()
+                raise
+    except BaseException:
+        # Remove the incomplete output so it is not mistaken for a finished extraction
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        raise
+    finally:
+        # The workers have stopped once the executor is shut down, so no more parts can appear
+        for part_file in part_files:
+            if os.path.exists(part_file):
+                os.remove(part_file)
+
+def _split_byte_ranges(input_file, range_size) -> list:
+    """
+    Split the data rows of a CSV file into byte ranges that start and end on line boundaries.
+
+    Args:
+        input_file (csv): Input CSV file
+        range_size (int): Approximate size in bytes of each range
+
+    Returns:
+        list[tuple[int, int]]: Start and end byte offsets of each range
+    """
+    file_size = os.path.getsize(input_file)
+    with open(input_file, 'rb') as f:
+        # The first range starts after the header
+        boundaries = [len(f.readline())]
+        for pos in range(boundaries[0] + range_size, file_size, range_size):
+            # Move the boundary forward to the start of the next line
+            f.seek(pos)
+            f.readline()
+            boundary = f.tell()
+            if boundaries[-1] < boundary < file_size:
+                boundaries.append(boundary)
+    boundaries.append(file_size)
+    return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if start < end]
+
+def _extract_range(input_file, start, end, indices, output_file, chunksize):
+    """
+    Extract specific columns from a byte range of a CSV file and write them, without a header, to a new CSV file.
+
+    Args:
+        input_file (csv): Input CSV file
+        start (int): Byte offset of the first row in the range
+        end (int): Byte offset just after the last row in the range
+        indices (list[int]): Positions of the columns to extract, in output order
+        output_file (csv): Output CSV file
+        chunksize (int): Number of rows that load at once
+    """
+    with open(input_file, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    with io.TextIOWrapper(io.BytesIO(data), newline='') as infile, open(output_file, 'w', newline='', buffering=1 << 20) as outfile:
+        _write_columns(csv.reader(infile), csv.writer(outfile, lineterminator='\n'), indices, chunksize)
 
 def get_file_length(input_file) -> int:
     """
@@ -47,7 +181,32 @@ def get_file_length(input_file) -> int:
     Returns:
         integer: Number of rows in the CSV file
     """
-    return sum(1 for _ in open(input_file)) - 1  # Subtract 1 for the header
+    # Key the cache on the modification time and size so edited files are recounted
+    stat = os.stat(input_file)
+    return _count_lines(input_file, stat.st_mtime_ns, stat.st_size) - 1  # Subtract 1 for the header
+
+@lru_cache(maxsize=128)
+def _count_lines(input_file, mtime_ns, size) -> int:
+    """
+    Count the lines in a file by counting newline bytes in large blocks.
+
+    Args:
+        input_file (csv): Input CSV file
+        mtime_ns (int): Modification time of the file, used as part of the cache key
+        size (int): Size of the file in bytes, used as part of the cache key
+
+    Returns:
+        integer: Number of lines in the file
+    """
+    if size == 0:
+        return 0
+    num_lines = _count_newlines(input_file, 0, size)
+    # Count a final line that has no trailing newline
+    with open(input_file, 'rb') as f:
+        f.seek(size - 1)
+        if f.read(1) != b'\n':
+            num_lines += 1
+    return num_lines
 
 def list_columns(input_file):
     """
@@ -59,8 +218,25 @@ def list_columns(input_file):
     Returns:
         list[strings]: List of column names
     """
-    df = pd.read_csv(input_file, nrows=0)
-    return df.columns.tolist()
+    # Key the cache on the modification time and size so edited files are reread
+    stat = os.stat(input_file)
+    return list(_read_header(input_file, stat.st_mtime_ns, stat.st_size))
+
+@lru_cache(maxsize=128)
+def _read_header(input_file, mtime_ns, size) -> tuple:
+    """
+    Read the header row of a CSV file.
+
+    Args:
+        input_file (csv): Input CSV file
+        mtime_ns (int): Modification time of the file, used as part of the cache key
+        size (int): Size of the file in bytes, used as part of the cache key
+
+    Returns:
+        tuple[strings]: Column names
+    """
+    with open(input_file, newline='') as f:
+        return tuple(next(csv.reader(f), []))
 
 def show_preview(input_file, num_rows=5):
     """
@@ -73,7 +249,7 @@ def show_preview(input_file, num_rows=5):
     df = pd.read_csv(input_file, nrows=num_rows)
     print(df)
 
-def find_sync_point(file_1, file_2, sync_column):
+def find_sync_point(file_1, file_2, sync_column, monotonic=False):
     """
     Find the sync point between two CSV files based on a common column.
 
@@ -81,23 +257,167 @@ def find_sync_point(file_1, file_2, sync_column):
         file_1 (csv): First CSV file
         file_2 (csv): Second CSV file
         sync_column (string): Column to use for synchronization
+        monotonic (bool, optional): Whether the sync column is numeric and increases monotonically, allowing
+            a binary search over the file instead of a full scan. Defaults to False.
 
     Returns:
         int: Index of the sync point in the first CSV file
     """
-    # Read the sync value from the sync column of the second file
-    sync_value = pd.read_csv(file_2, usecols=[sync_column]).iloc[0][sync_column]
-
-    # Find the index of the sync value in the first file
-    for chunk in pd.read_csv(file_1, chunksize=10000):
-        for index, row in chunk.iterrows():
-            if row[sync_column] == sync_value:
-                return index
+    # Read the sync value from the first row of the second file
+    sync_value = _read_sync_value(file_2, sync_column)
+
+    sync_col_index = list_columns(file_1).index(sync_column)
+    with open(file_1, 'rb') as f:
+        data_start = len(f.readline())
+        if monotonic:
+            offset = _bisect_sync_offset(f, sync_value, sync_col_index, data_start)
+            if offset != -1:
+                # The index of the sync row is the number of rows before it
+                return _count_newlines(file_1, data_start, offset)
+        else:
+            sync_point, _ = _scan_sync_row(f, sync_value, sync_col_index)
+            if sync_point != -1:
+                return sync_point
     # Return -1 if the sync value is not found
     print(f"Sync value {sync_value} not found in {file_1}")
     return -1
 
-def create_synced_data(file_1, file_2, sync_column):
+def _bisect_sync_offset(f, sync_value, sync_col_index, data_start) -> int:
+    """
+    Binary search a CSV file sorted on its sync column for the first row matching a value.
+
+    Args:
+        f (file): CSV file opened in binary mode
+        sync_value (float): Value of the sync column to search for
+        sync_col_index (int): Position of the sync column in the file
+        data_start (int): Byte offset of the first data row
+
+    Returns:
+        int: Byte offset of the first matching row, or -1 if no row matches
+    """
+    if not isinstance(sync_value, float):
+        raise ValueError(f"Binary search for the sync point needs a numeric sync column, got {sync_value!r}")
+
+    # Every row starting before lo is below the sync value, and the first row
+    # at or above it starts at or before hi
+    lo, hi = data_start, os.fstat(f.fileno()).st_size
+    while hi - lo > (1 << 16):
+        mid = (lo + hi) // 2
+        # Skip to the start of the next full row
+        f.seek(mid)
+        f.readline()
+        row_start = f.tell()
+        # Skip rows that do not parse as a number, such as a truncated last row
+        value = None
+        while value is None and row_start < hi:
+            value = _parse_sync_field(f.readline(), sync_col_index)
+            if not isinstance(value, float):
+                value = None
+                row_start = f.tell()
+        if value is None:
+            break
+        if value < sync_value:
+            lo = f.tell()
+        else:
+            hi = row_start
+
+    # Scan the remaining window row by row
+    f.seek(lo)
+    row_start = lo
+    for line in iter(f.readline, b''):
+        value = _parse_sync_field(line, sync_col_index)
+        if isinstance(value, float) and value >= sync_value:
+            return row_start if value == sync_value else -1
+        row_start += len(line)
+    return -1
+
+def _scan_sync_row(f, sync_value, sync_col_index):
+    """
+    Scan the rows of a CSV file for the first one whose sync column matches a value.
+
+    Args:
+        f (file): CSV file opened in binary mode, positioned at the first data row
+        sync_value (float or string): Value of the sync column to search for
+        sync_col_index (int): Position of the sync column in the file
+
+    Returns:
+        tuple[int, bytes]: Index of the matching row and the row itself, or (-1, b'') if no row matches.
+            The file is left positioned just after the matching row.
+    """
+    for sync_point, line in enumerate(f):
+        if _parse_sync_field(line, sync_col_index) == sync_value:
+            return sync_point, line
+    return -1, b''
+
+def _read_sync_value(file_2, sync_column):
+    """
+    Read the value of the sync column in the first data row of a CSV file.
+
+    Args:
+        file_2 (csv): Second CSV file
+        sync_column (string): Column to use for synchronization
+
+    Returns:
+        float or string: Value of the sync column in the first data row
+    """
+    sync_col_index = list_columns(file_2).index(sync_column)
+    with open(file_2, 'rb') as f:
+        f.readline()
+        line = f.readline()
+    sync_value = _parse_sync_field(line, sync_col_index)
+    if sync_value is None:
+        raise ValueError(f"{file_2} has no data row with a value in column {sync_column}")
+    return sync_value
+
+def _parse_sync_field(line, sync_col_index):
+    """
+    Parse the sync column of a raw CSV row, as a number if possible and as text otherwise.
+
+    Args:
+        line (bytes): Row of a CSV file
+        sync_col_index (int): Position of the sync column in the row
+
+    Returns:
+        float or string: Value of the sync column, or None if the row is too short
+    """
+    fields = line.rstrip(b'\r\n').split(b',')
+    if sync_col_index >= len(fields):
+        return None
+    field = fields[sync_col_index]
+    # Remove surrounding quotes, as pandas does, so "2.5" and 2.5 compare equal
+    if len(field) >= 2 and field[:1] == b'"' and field[-1:] == b'"':
+        field = field[1:-1]
+    try:
+        return float(field)
+    except ValueError:
+        return field.decode()
+
+def _count_newlines(input_file, start, end) -> int:
+    """
+    Count the newline bytes in a range of a file by memory-mapping it and counting with numpy.
+
+    Args:
+        input_file (csv): Input CSV file
+        start (int): Byte offset of the start of the range
+        end (int): Byte offset of the end of the range
+
+    Returns:
+        int: Number of newlines in the range
+    """
+    end = min(end, os.path.getsize(input_file))
+    if start >= end:
+        return 0
+    num_newlines = 0
+    with open(input_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        data = np.frombuffer(mm, dtype=np.uint8)
+        for block_start in range(start, end, 1 << 24):
+            block = data[block_start:min(block_start + (1 << 24), end)]
+            num_newlines += int(np.count_nonzero(block == ord('\n')))
+        # Release the views of the map before it is closed
+        del data, block
+    return num_newlines
+
+def create_synced_data(file_1, file_2, sync_column, monotonic=False):
     """
     Remove data from the beginning of the first CSV file up to the sync point.
 
@@ -105,55 +425,108 @@ def create_synced_data(file_1, file_2, sync_column):
         file_1 (csv): First CSV file
         file_2 (csv): Second CSV file
         sync_column (string): Column to use for synchronization
+        monotonic (bool, optional): Whether the sync column is numeric and increases monotonically, allowing
+            a binary search for the sync point. Defaults to False.
     """
-    # Find the sync point
-    sync_point = find_sync_point(file_1, file_2, sync_column)
+    # Read the sync value from the first row of the second file
+    sync_value = _read_sync_value(file_2, sync_column)
+
+    # Find the position of the sync column in the first file
+    header_1 = list_columns(file_1)
+    sync_col_index = header_1.index(sync_column)
+
+    # create a copy of file_1 with the data up to the sync point removed
+    file_1_mod = file_1.replace('.csv', '-sync.csv')
+    print("Removing data and creating synced copy of file_1")
+    sync_point, num_rows_1 = sync_and_write(file_1, sync_value, sync_col_index, file_1_mod, monotonic)
 
     # Return if the sync point is not found
     if sync_point == -1:
+        print(f"Sync value {sync_value} not found in {file_1}")
         return
     print(f"Sync point found at index {sync_point}")
 
-    # get file_1 length
-    total_rows_1 = get_file_length(file_1)
+    # create a copy of file_2, which copyfile does in the kernel with sendfile where available
+    file_2_mod = file_2.replace('.csv', '-sync.csv')
+    print("Creating synced copy of file_2")
+    shutil.copyfile(file_2, file_2_mod)
 
-    # get the header from file_1
-    header_1 = pd.read_csv(file_1, nrows=0).columns
+    # check if the files are of same length
+    if num_rows_1 == get_file_length(file_2_mod):
+        print("Synced files created successfully")
 
-    # create a copy of file_1
-    file_1_mod = file_1.replace('.csv', '-sync.csv')
+def sync_and_write(file_1, sync_value, sync_col_index, output_file, monotonic=False) -> tuple:
+    """
+    Copy the rows of a CSV file starting from the first row whose sync column matches a value,
+    finding the sync point and writing the copy in a single pass over the file.
 
-    # Read the file in chunks and remove the data up to the sync point
-    # Ignore the header row
-    with tqdm(total=total_rows_1, desc="Removing data and creating synced copy of file_1") as pbar:
-        pbar.update(sync_point)
-        # Write the header
-        with open(file_1_mod, 'w', newline='') as outfile:
-            writer = csv.writer(outfile)
-            writer.writerow(header_1)
-        for chunk in pd.read_csv(file_1, chunksize=10000, skiprows=range(1, sync_point + 1)):
-            chunk.to_csv(file_1_mod, mode='a', header=False, index=False)
-            pbar.update(len(chunk))
+    Args:
+        file_1 (csv): Input CSV file
+        sync_value (float or string): Value of the sync column at the sync point
+        sync_col_index (int): Position of the sync column in the input file
+        output_file (csv): Output CSV file, only created if the sync value is found
+        monotonic (bool, optional): Whether the sync column is numeric and increases monotonically, allowing
+            a binary search for the sync point instead of scanning the rows before it. Defaults to False.
 
-    # get file_2 length
-    total_rows_2 = get_file_length(file_2)
+    Returns:
+        tuple[int, int]: Index of the sync point in the input file and number of rows written,
+            or (-1, 0) if the sync value is not found
+    """
+    with open(file_1, 'rb') as infile:
+        header = infile.readline()
+
+        if monotonic:
+            # Jump straight to the sync point
+            offset = _bisect_sync_offset(infile, sync_value, sync_col_index, len(header))
+            if offset == -1:
+                return -1, 0
+            # The index of the sync row is the number of rows before it
+            sync_point = _count_newlines(file_1, len(header), offset)
+            infile.seek(offset)
+            line = infile.readline()
+        else:
+            sync_point, line = _scan_sync_row(infile, sync_value, sync_col_index)
+            if sync_point == -1:
+                return -1, 0
+
+        # Copy the sync row and everything after it
+        with open(output_file, 'wb', buffering=1 << 20) as outfile:
+            outfile.write(header)
+            outfile.write(line)
+            num_rows = line.count(b'\n')
+            last_byte = line[-1:]
+            for block in iter(lambda: infile.read(1 << 20), b''):
+                outfile.write(block)
+                num_rows += block.count(b'\n')
+                last_byte = block[-1:]
+
+    # Count a final row that has no trailing newline
+    if last_byte != b'\n':
+        num_rows += 1
+    return sync_point, num_rows
+
+def convert_to_parquet(input_file, output_file=None, columns_to_convert=None, dtype=None):
+    """
+    Convert a CSV file to a snappy-compressed Parquet file, so later reads skip CSV parsing.
+    Requires pyarrow or fastparquet to be installed.
 
-    # get the header from file_2
-    header_2 = pd.read_csv(file_2, nrows=0).columns
+    Args:
+        input_file (csv): Input CSV file
+        output_file (parquet, optional): Output Parquet file. Defaults to the input file name with a .parquet extension.
+        columns_to_convert (list[strings], optional): List of column names to keep. Defaults to all columns.
+        dtype (dict, optional): Data types of the columns, e.g. 'float32' for the joint positions to halve
+            their memory and file size. Defaults to the types inferred by pandas.
 
-    # create a copy of file_2
-    file_2_mod = file_2.replace('.csv', '-sync.csv')
-    with tqdm (total=total_rows_2, desc="Creating synced copy of file_2") as pbar:
-        with open(file_2_mod, 'w', newline='') as outfile:
-            writer = csv.writer(outfile)
-            writer.writerow(header_2)
-        for chunk in pd.read_csv(file_2, chunksize=10000):
-            chunk.to_csv(file_2_mod, mode='a', header=False, index=False)
-            pbar.update(len(chunk))
+    Returns:
+        string: Path of the Parquet file
+    """
+    if output_file is None:
+        output_file = input_file.replace('.csv', '.parquet')
 
-    # check if the files are of same length
-    if get_file_length(file_1_mod) == get_file_length(file_2_mod):
-        print("Synced files created successfully")
+    df = pd.read_csv(input_file, usecols=columns_to_convert, dtype=dtype)
+    df.to_parquet(output_file, compression='snappy', index=False)
+
+    return output_file
 
 def calc_average_frequency(input_file, time_column_name):
     """
@@ -202,8 +575,9 @@ if __name__ == "__main__":
     # file_1 = "/home/abhi2001/SRA/Dyadic_Model/data/X2_SRA_A_07-05-2024_10-39-10-mod.csv"
     # file_2 = "/home/abhi2001/SRA/Dyadic_Model/data/X2_SRA_B_07-05-2024_10-41-46-mod.csv"
     # sync_column = ' TimeInteractionSubscription'
-    # # print(find_sync_point(file_1, file_2, sync_column))
-    # create_synced_data(file_1, file_2, sync_column)
+    # # print(find_sync_point(file_1, file_2, sync_column, monotonic=True))
+    # create_synced_data(file_1, file_2, sync_column, monotonic=True)
+    # # convert_to_parquet(file_1.replace('.csv', '-sync.csv'), dtype={col: 'float32' for col in columns_to_extract[1:]})
 
     input_file = "/home/abhi2001/SRA/Dyadic_Model/data/X2_SRA_A_07-05-2024_10-39-10-mod-sync.csv"
     time_column_name = ' TimeInteractionSubscription'